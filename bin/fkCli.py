@@ -1,16 +1,13 @@
 #!/usr/bin/env python3
 
 import json
+import sys
 import traceback
 from datetime import datetime
 from inspect import signature
-from typing import List
+from typing import Callable, Dict, List, Tuple
 
 import click
-from prompt_toolkit import PromptSession
-from prompt_toolkit.auto_suggest import AutoSuggestFromHistory
-from prompt_toolkit.completion import WordCompleter
-from prompt_toolkit.history import FileHistory
 
 from faaskeeper.client import FaaSKeeperClient
 from faaskeeper.config import CloudProvider, Config
@@ -51,8 +48,6 @@ clientAPIMapping = {
     "connect": "start",
 }
 
-fkCompleter = WordCompleter(keywords, ignore_case=True)
-
 
 def watch_callback(watch_event: WatchedEvent):
     click.echo(
@@ -60,6 +55,47 @@ def watch_callback(watch_event: WatchedEvent):
     )
 
 
+def _convert_watch(arg: str):
+    return watch_callback if arg.lower() == "true" else None
+
+
+def _build_cmd_specs() -> Dict[str, Tuple[str, List[Callable], str]]:
+    """
+    The API mapping and client class are fixed - parse signatures only once.
+    For each command we store the client method name, a list of argument
+    converters and the usage message.
+    """
+    specs = {}
+    for cmd, method in clientAPIMapping.items():
+        sig = signature(getattr(FaaSKeeperClient, method))
+        # skip "self"
+        params = list(sig.parameters.values())[1:]
+        converters: List[Callable] = []
+        msg = f"{cmd} arguments:"
+        for param in params:
+            # "watch" requires conversion - API uses a callback
+            # the CLI is a boolean switch if callback should be use or not
+            if param.name == "watch":
+                msg += " watch:bool"
+                converters.append(_convert_watch)
+                continue
+
+            # typing generics, e.g., Optional[int], have no __name__ before Python 3.10
+            type_name = getattr(param.annotation, "__name__", str(param.annotation))
+            msg += f" {param.name}:{type_name}"
+            if bytes == param.annotation:
+                converters.append(str.encode)
+            elif bool == param.annotation:
+                converters.append(bool)
+            else:
+                converters.append(str)
+        specs[cmd] = (method, converters, msg)
+    return specs
+
+
+_CMD_SPECS = _build_cmd_specs()
+
+
 def process_cmd(client: FaaSKeeperClient, cmd: str, args: List[str]):
 
     # process commands not offered by the API
@@ -68,41 +104,15 @@ def process_cmd(client: FaaSKeeperClient, cmd: str, args: List[str]):
             click.echo_via_pager(client.logs())
         return client.session_status, client.session_id
 
-    # create mapping
-    function = getattr(client, clientAPIMapping[cmd])
-    sig = signature(function)
-    params_count = len(sig.parameters)
+    method, converters, usage = _CMD_SPECS[cmd]
+    function = getattr(client, method)
     # incorrect number of parameters
-    if params_count != len(args):
-        msg = f"{cmd} arguments:"
-        for param in sig.parameters.values():
-            # "watch" requires conversion - API uses a callback
-            # the CLI is a boolean switch if callback should be use or not
-            if param.name == "watch":
-                msg += f" watch:bool"
-            else:
-                msg += f" {param.name}:{param.annotation.__name__}"
-        click.echo(msg)
+    if len(converters) != len(args):
+        click.echo(usage)
         return client.session_status, client.session_id
 
     # convert arguments
-    converted_arguments = []
-    for idx, param in enumerate(sig.parameters.values()):
-        # "watch" requires conversion - API uses a callback
-        # the CLI is a boolean switch if callback should be use or not
-        if param.name == "watch":
-            if args[idx].lower() == "true":
-                converted_arguments.append(watch_callback)
-            else:
-                converted_arguments.append(None)
-            continue
-
-        if bytes == param.annotation:
-            converted_arguments.append(args[idx].encode())
-        elif bool == param.annotation:
-            converted_arguments.append(bool(args[idx]))
-        else:
-            converted_arguments.append(args[idx])
+    converted_arguments = [conv(arg) for conv, arg in zip(converters, args)]
     try:
         ret = function(*converted_arguments)
 
@@ -142,11 +152,21 @@ def process_cmd(client: FaaSKeeperClient, cmd: str, args: List[str]):
 @click.option("--port", type=int, default=-1)
 @click.option("--verbose/--no-verbose", type=bool, default=False)
 def cli(config, port: int, verbose: str):
-    session = PromptSession(
-        completer=fkCompleter,
-        history=FileHistory("fk_history.txt"),
-        auto_suggest=AutoSuggestFromHistory(),
-    )
+
+    # prompt_toolkit is only needed for interactive sessions
+    # scripted input is read line by line without the cost of the prompt
+    session = None
+    if sys.stdin.isatty():
+        from prompt_toolkit import PromptSession
+        from prompt_toolkit.auto_suggest import AutoSuggestFromHistory
+        from prompt_toolkit.completion import WordCompleter
+        from prompt_toolkit.history import FileHistory
+
+        session = PromptSession(
+            completer=WordCompleter(keywords, ignore_case=True),
+            history=FileHistory("fk_history.txt"),
+            auto_suggest=AutoSuggestFromHistory(),
+        )
 
     status = "DISCONNECTED"
     counter = 0
@@ -166,12 +186,19 @@ def cli(config, port: int, verbose: str):
         import traceback
         traceback.print_exc()
 
+    lines = iter(sys.stdin)
     while True:
         try:
-            text = session.prompt(
-                f"[fk: {datetime.now()} {provider}:{service_name}({status}) "
-                f"session:{session_id} {counter}] "
-            )
+            if session is None:
+                line = next(lines, None)
+                if line is None:
+                    break
+                text = line.rstrip("\n")
+            else:
+                text = session.prompt(
+                    f"[fk: {datetime.now()} {provider}:{service_name}({status}) "
+                    f"session:{session_id} {counter}] "
+                )
         except KeyboardInterrupt:
             continue
         except EOFError:
@@ -2,6 +2,7 @@ from typing import Set, Union
 
 import boto3
 from boto3.dynamodb.types import TypeSerializer
+from botocore.config import Config
 
 from faaskeeper.node import Node, NodeDataType
 from faaskeeper.stats import StorageStatistics
@@ -10,12 +11,31 @@ from .storage import Storage
 
 
 class DynamoStorage(Storage):
+
+    _client = None
+
     def __init__(self, table_name: str, key_name: str):
         super().__init__(table_name)
-        self._dynamodb = boto3.client("dynamodb")
+        self._dynamodb = DynamoStorage.client()
         self._type_serializer = TypeSerializer()
         self._key_name = key_name
 
+    @staticmethod
+    def client():
+        """
+        All tables share a single client and its connection pool.
+        The client is created once per container and reused by warm invocations.
+        """
+        if DynamoStorage._client is None:
+            DynamoStorage._client = boto3.client(
+                "dynamodb",
+                config=Config(
+                    max_pool_connections=50,
+                    retries={"max_attempts": 3, "mode": "adaptive"},
+                ),
+            )
+        return DynamoStorage._client
+
     def write(self, key: str, data: Union[dict, bytes]):
         """DynamoDb write"""
 
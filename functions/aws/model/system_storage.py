@@ -1,5 +1,9 @@
+import logging
+import random
 from abc import ABC, abstractmethod
-from typing import Optional, Set, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from time import sleep
+from typing import AbstractSet, List, Optional, Sequence, Tuple
 
 from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
 
@@ -8,6 +12,10 @@ from faaskeeper.stats import StorageStatistics
 from faaskeeper.version import SystemCounter, Version
 from functions.aws.control.dynamo import DynamoStorage as DynamoDriver
 
+# Locks on different nodes are independent requests - we issue them concurrently.
+# boto3 clients are thread-safe and the pool threads share the client.
+_POOL = ThreadPoolExecutor(max_workers=4)
+
 
 class Storage(ABC):
     @property
@@ -18,6 +26,15 @@ class Storage(ABC):
         """
         return 7
 
+    @property
+    def lock_wait(self) -> int:
+        """
+        Locks compare whole seconds: a lock abandoned with timestamp t
+        can be taken over once int(now) >= t + lock_lifetime + 1.
+        We wait one more second to cover the last attempt.
+        """
+        return self.lock_lifetime + 2
+
     @abstractmethod
     def delete_user(self, session_id: str):
         """
@@ -29,17 +46,38 @@ class Storage(ABC):
     def lock_node(self, path: str, timestamp: int) -> Tuple[bool, Optional[Node]]:
         pass
 
+    @abstractmethod
+    def lock_nodes(
+        self, paths: List[str], timestamp: int
+    ) -> Tuple[bool, List[Optional[Node]]]:
+        pass
+
     @abstractmethod
     def unlock_node(self, path: str, timestamp: int):
         pass
 
+    @abstractmethod
+    def unlock_nodes(self, locks: List[Tuple[str, int]]) -> bool:
+        pass
+
     @abstractmethod
     def delete_node(self, node: Node, timestamp: int):
         pass
 
     @abstractmethod
     def commit_node(
-        self, node: Node, timestamp: int, updates: Set[NodeDataType] = set()
+        self,
+        node: Node,
+        timestamp: int,
+        updates: AbstractSet[NodeDataType] = frozenset(),
+    ) -> bool:
+        pass
+
+    @abstractmethod
+    def commit_nodes_transactional(
+        self,
+        updates: List[Tuple[Node, int, AbstractSet[NodeDataType]]],
+        deletions: Sequence[Tuple[Node, int]] = (),
     ) -> bool:
         pass
 
@@ -53,11 +91,21 @@ class DynamoStorage(Storage):
     # FIXME: implement counter increase
     # FIXME: implement epoch counter change
 
+    # create timelock
+    _LOCK_UPDATE_EXPR = "SET timelock = :newlockvalue"
+    # lock doesn't exist or it's already expired
+    _LOCK_COND_EXPR = "(attribute_not_exists(timelock)) or (timelock < :newlockshifted)"
+    # lock exists and it's ours
+    _HOLDS_LOCK_COND_EXPR = "(attribute_exists(timelock)) and (timelock = :mytimelock)"
+    # retries of a commit transaction cancelled by a conflicting request
+    _TRANSACTION_CONFLICT_RETRIES = 3
+
     def __init__(self, storage_name: str):
         self._users_storage = DynamoDriver(f"{storage_name}-users", "user")
         self._state_storage = DynamoDriver(f"{storage_name}-state", "path")
         self._type_serializer = TypeSerializer()
         self._type_deserializer = TypeDeserializer()
+        self._lock_lifetime = self.lock_lifetime
 
     def delete_user(self, session_id: str) -> bool:
         try:
@@ -67,59 +115,130 @@ class DynamoStorage(Storage):
             return False
 
     def lock_node(self, path: str, timestamp: int) -> Tuple[bool, Optional[Node]]:
+        """
+        The conditional update is always evaluated against the latest version
+        of the item, and ALL_NEW returns the node state after locking.
+        Thus, we never need a separate (possibly stale) read of the node.
+
+        The lock is deliberately a single attribute on the node's row:
+        the same row stores the node's counters and children, and writers
+        must be serialized on it. Handing out per-writer "slots" under a sort
+        key would let concurrent writers proceed on the same node.
+        """
+
+        locked, node, units = self._lock_node(path, timestamp)
+        if locked:
+            StorageStatistics.instance().add_write_units(units)
+        return (locked, node)
+
+    def _lock_node(
+        self, path: str, timestamp: int
+    ) -> Tuple[bool, Optional[Node], float]:
+        """
+        Returns the consumed capacity instead of recording it,
+        since statistics are not thread-safe and we lock nodes concurrently.
+        """
 
         # FIXME: move this to the interface of control driver
-        # we set the timelock value to the timestamp
-        # for comparison, we subtract from the timestamp the maximum lock holding time
         try:
             ret = self._state_storage._dynamodb.update_item(
-                TableName=self._state_storage.storage_name,
-                # path to the node
-                Key={"path": {"S": path}},
-                # create timelock
-                UpdateExpression="SET timelock = :newlockvalue",
-                # lock doesn't exist or it's already expired
-                ConditionExpression="(attribute_not_exists(timelock)) or "
-                "(timelock < :newlockshifted)",
-                # timelock value
-                ExpressionAttributeValues={
-                    ":newlockvalue": {"N": str(timestamp)},
-                    ":newlockshifted": {"N": str(timestamp - self.lock_lifetime)},
-                },
+                **self._lock_update(path, timestamp),
                 ReturnValues="ALL_NEW",
                 ReturnConsumedCapacity="TOTAL",
             )
-            # print("lock", ret["ConsumedCapacity"])
-            StorageStatistics.instance().add_write_units(
-                ret["ConsumedCapacity"]["CapacityUnits"]
-            )
+            logging.debug("lock %s: %s", path, ret["ConsumedCapacity"])
             # store raw provider data
-            data = ret["Attributes"]
-            n: Optional[Node] = None
-            # FIXME: merge with library code?
-            # node already exists
-            if "cFxidSys" in data:
-                n = Node(path)
-                created = SystemCounter.from_provider_schema(
-                    data["cFxidSys"]  # type: ignore
-                )
-                n.created = Version(
-                    created,
-                    None
-                    # EpochCounter.from_provider_schema(data["cFxidEpoch"]),
-                )
-                modified = SystemCounter.from_provider_schema(
-                    data["mFxidSys"]  # type: ignore
-                )
-                n.modified = Version(
-                    modified,
-                    None
-                    # EpochCounter.from_provider_schema(data["mFxidEpoch"]),
-                )
-                n.children = self._type_deserializer.deserialize(data["children"])
-            return (True, n)
+            return (
+                True,
+                self._parse_node(path, ret["Attributes"]),
+                ret["ConsumedCapacity"]["CapacityUnits"],
+            )
         except self._state_storage.errorSupplier.ConditionalCheckFailedException:
-            return (False, None)
+            return (False, None, 0.0)
+        # a transaction of another writer is in progress on the node -
+        # it still holds the lock, and we retry like for a held lock
+        except self._state_storage.errorSupplier.TransactionConflictException:
+            return (False, None, 0.0)
+
+    def lock_nodes(
+        self, paths: List[str], timestamp: int
+    ) -> Tuple[bool, List[Optional[Node]]]:
+        """
+        Lock all nodes with concurrent conditional updates. This costs one round
+        trip and the same capacity as single locks - a transaction would bill
+        double capacity and require a second request to read the nodes.
+
+        Acquisition is all-or-nothing: if any lock fails, we immediately release
+        the locks acquired. Thus, we never hold one lock while waiting for another.
+        """
+
+        futures = [_POOL.submit(self._lock_node, path, timestamp) for path in paths]
+        results: List[Tuple[bool, Optional[Node], float]] = []
+        error: Optional[Exception] = None
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                results.append((False, None, 0.0))
+                error = e
+        StorageStatistics.instance().add_write_units(
+            sum(units for _, _, units in results)
+        )
+
+        if error is None and all(locked for locked, _, _ in results):
+            return (True, [node for _, node, _ in results])
+
+        acquired = [
+            (path, timestamp) for path, (locked, _, _) in zip(paths, results) if locked
+        ]
+        if len(acquired):
+            self.unlock_nodes(acquired)
+        if error is not None:
+            raise error
+        return (False, [None] * len(paths))
+
+    def _lock_update(self, path: str, timestamp: int) -> dict:
+
+        # we set the timelock value to the timestamp
+        # for comparison, we subtract from the timestamp the maximum lock holding time
+        return {
+            "TableName": self._state_storage.storage_name,
+            # path to the node
+            "Key": {"path": {"S": path}},
+            "UpdateExpression": DynamoStorage._LOCK_UPDATE_EXPR,
+            "ConditionExpression": DynamoStorage._LOCK_COND_EXPR,
+            # timelock value
+            "ExpressionAttributeValues": {
+                ":newlockvalue": {"N": str(timestamp)},
+                ":newlockshifted": {"N": str(timestamp - self._lock_lifetime)},
+            },
+        }
+
+    def _parse_node(self, path: str, data: dict) -> Optional[Node]:
+
+        n: Optional[Node] = None
+        # FIXME: merge with library code?
+        # node already exists
+        if "cFxidSys" in data:
+            n = Node(path)
+            created = SystemCounter.from_provider_schema(
+                data["cFxidSys"]  # type: ignore
+            )
+            n.created = Version(
+                created,
+                None
+                # EpochCounter.from_provider_schema(data["cFxidEpoch"]),
+            )
+            modified = SystemCounter.from_provider_schema(
+                data["mFxidSys"]  # type: ignore
+            )
+            n.modified = Version(
+                modified,
+                None
+                # EpochCounter.from_provider_schema(data["mFxidEpoch"]),
+            )
+            n.children = self._type_deserializer.deserialize(data["children"])
+        return n
 
     def unlock_node(self, path: str, timestamp: int) -> bool:
         """
@@ -130,8 +249,28 @@ class DynamoStorage(Storage):
         """
         return self.commit_node(Node(path), timestamp)
 
+    def unlock_nodes(self, locks: List[Tuple[str, int]]) -> bool:
+        """
+        Release multiple locks with a single transaction.
+
+        A transaction fails as a whole if any of the locks has expired in the
+        meantime. Then, we fall back to releasing the locks one by one
+        to not leave the remaining nodes locked.
+        """
+        if len(locks) == 1:
+            return self.unlock_node(*locks[0])
+
+        if self.commit_nodes_transactional(
+            [(Node(path), timestamp, frozenset()) for path, timestamp in locks]
+        ):
+            return True
+        return all([self.unlock_node(path, timestamp) for path, timestamp in locks])
+
     def commit_node(
-        self, node: Node, timestamp: int, updates: Set[NodeDataType] = set()
+        self,
+        node: Node,
+        timestamp: int,
+        updates: AbstractSet[NodeDataType] = frozenset(),
     ) -> bool:
 
         """
@@ -144,43 +283,11 @@ class DynamoStorage(Storage):
 
         # FIXME: move this to the interface of control driver
         try:
-            # we always commit the modified stamp
-            update_expr = "REMOVE timelock "
-            if len(updates):
-                update_expr = f"{update_expr} SET "
-            update_values = {}
-
-            if NodeDataType.CREATED in updates:
-                update_expr = f"{update_expr} cFxidSys = :createdStamp,"
-                update_values[":createdStamp"] = node.created.system.version
-            if NodeDataType.MODIFIED in updates:
-                update_expr = f"{update_expr} mFxidSys = :modifiedStamp,"
-                update_values[":modifiedStamp"] = node.modified.system.version
-            if NodeDataType.CHILDREN in updates:
-                update_expr = f"{update_expr} children = :children,"
-                update_values[":children"] = self._type_serializer.serialize(  # type: ignore
-                    node.children  # type: ignore
-                )
-            # strip traling comma - boto3 will not accept that
-            update_expr = update_expr[:-1]
-
             ret = self._state_storage._dynamodb.update_item(
-                TableName=self._state_storage.storage_name,
-                # path to the node
-                Key={"path": {"S": node.path}},
-                # create timelock
-                UpdateExpression=update_expr,
-                # lock doesn't exist or it's already expired
-                ConditionExpression="(attribute_exists(timelock)) "
-                "and (timelock = :mytimelock)",
-                # timelock value
-                ExpressionAttributeValues={
-                    ":mytimelock": {"N": str(timestamp)},
-                    **update_values,
-                },
+                **self._commit_update(node, timestamp, updates),
                 ReturnConsumedCapacity="TOTAL",
             )
-            # print("commit", ret["ConsumedCapacity"])
+            logging.debug("commit %s: %s", node.path, ret["ConsumedCapacity"])
             StorageStatistics.instance().add_write_units(
                 ret["ConsumedCapacity"]["CapacityUnits"]
             )
@@ -188,7 +295,116 @@ class DynamoStorage(Storage):
         except self._state_storage.errorSupplier.ConditionalCheckFailedException:
             return False
 
+    def commit_nodes_transactional(
+        self,
+        updates: List[Tuple[Node, int, AbstractSet[NodeDataType]]],
+        deletions: Sequence[Tuple[Node, int]] = (),
+    ) -> bool:
+        """
+        Commit and delete multiple nodes in a single transaction.
+        Each update and deletion is conditioned on us still holding the timelock.
+        Either all changes are applied, or none of them.
+
+        Lock attempts of other writers on our nodes are single-item writes,
+        and DynamoDB cancels the transaction when one of them is in progress.
+        Such conflicts are transient - we still hold all locks - and we retry.
+        Failing here would waste the counter value already taken by the caller.
+        """
+
+        transaction: List[dict] = [
+            {"Update": self._commit_update(node, timestamp, node_updates)}
+            for node, timestamp, node_updates in updates
+        ]
+        transaction.extend(
+            {"Delete": self._delete_update(node, timestamp)}
+            for node, timestamp in deletions
+        )
+
+        # botocore attaches a random ClientRequestToken to each transaction and
+        # reuses it on retries. A token derived from paths and timestamps would be
+        # unsafe: identical requests of two writers would share it, and the second
+        # one would be told it succeeded without evaluating its conditions.
+        for attempt in range(DynamoStorage._TRANSACTION_CONFLICT_RETRIES + 1):
+            try:
+                ret = self._state_storage._dynamodb.transact_write_items(
+                    TransactItems=transaction,  # type: ignore
+                    ReturnConsumedCapacity="TOTAL",
+                )
+                StorageStatistics.instance().add_write_units(
+                    sum(table["CapacityUnits"] for table in ret["ConsumedCapacity"])
+                )
+                return True
+            except self._state_storage.errorSupplier.TransactionCanceledException as e:
+                reasons = {
+                    reason.get("Code")
+                    for reason in e.response.get("CancellationReasons", [])
+                }
+                # we lost one of the locks - retrying cannot help
+                if "TransactionConflict" not in reasons or (
+                    "ConditionalCheckFailed" in reasons
+                ):
+                    return False
+                sleep(0.05 * 2 ** attempt * random.uniform(0.5, 1.5))
+        logging.error(
+            f"Transaction cancelled by conflicts after {attempt + 1} attempts"
+        )
+        return False
+
+    def _commit_update(
+        self, node: Node, timestamp: int, updates: AbstractSet[NodeDataType]
+    ) -> dict:
+
+        # we always commit the modified stamp
+        update_expr = "REMOVE timelock "
+        if len(updates):
+            update_expr = f"{update_expr} SET "
+        update_values = {}
+
+        if NodeDataType.CREATED in updates:
+            update_expr = f"{update_expr} cFxidSys = :createdStamp,"
+            update_values[":createdStamp"] = node.created.system.version
+        if NodeDataType.MODIFIED in updates:
+            update_expr = f"{update_expr} mFxidSys = :modifiedStamp,"
+            update_values[":modifiedStamp"] = node.modified.system.version
+        if NodeDataType.CHILDREN in updates:
+            update_expr = f"{update_expr} children = :children,"
+            update_values[":children"] = self._type_serializer.serialize(  # type: ignore
+                node.children  # type: ignore
+            )
+        # strip traling comma - boto3 will not accept that
+        update_expr = update_expr[:-1]
+
+        return {
+            "TableName": self._state_storage.storage_name,
+            # path to the node
+            "Key": {"path": {"S": node.path}},
+            # create timelock
+            "UpdateExpression": update_expr,
+            "ConditionExpression": DynamoStorage._HOLDS_LOCK_COND_EXPR,
+            # timelock value
+            "ExpressionAttributeValues": {
+                ":mytimelock": {"N": str(timestamp)},
+                **update_values,
+            },
+        }
+
+    def _delete_update(self, node: Node, timestamp: int) -> dict:
+        return {
+            "TableName": self._state_storage.storage_name,
+            # path to the node
+            "Key": {"path": {"S": node.path}},
+            "ConditionExpression": DynamoStorage._HOLDS_LOCK_COND_EXPR,
+            # timelock value
+            "ExpressionAttributeValues": {":mytimelock": {"N": str(timestamp)}},
+        }
+
     def increase_system_counter(self, writer_id: int) -> Optional[SystemCounter]:
+        """
+        The new counter value is stored in the committed node, and we need
+        to know it before the commit is issued. Transactions do not return
+        updated values, thus the increase cannot be merged into the commit
+        transaction without an additional read of the counter.
+        """
 
         try:
             ret = self._state_storage._dynamodb.update_item(
@@ -202,7 +418,7 @@ class DynamoStorage(Storage):
                 ReturnValues="ALL_NEW",
                 ReturnConsumedCapacity="TOTAL",
             )
-            # print("counter", ret["ConsumedCapacity"])
+            logging.debug("counter: %s", ret["ConsumedCapacity"])
             StorageStatistics.instance().add_write_units(
                 ret["ConsumedCapacity"]["CapacityUnits"]
             )
@@ -215,14 +431,7 @@ class DynamoStorage(Storage):
     def delete_node(self, node: Node, timestamp: int):
 
         ret = self._state_storage._dynamodb.delete_item(
-            TableName=self._state_storage.storage_name,
-            # path to the node
-            Key={"path": {"S": node.path}},
-            # lock exists and it's ours
-            ConditionExpression="(attribute_exists(timelock)) "
-            "and (timelock = :mytimelock)",
-            # timelock value
-            ExpressionAttributeValues={":mytimelock": {"N": str(timestamp)}},
+            **self._delete_update(node, timestamp),
             ReturnConsumedCapacity="TOTAL",
         )
         StorageStatistics.instance().add_write_units(
@@ -1,10 +1,10 @@
 import logging
-import pathlib
+import random
 import time
 from abc import ABC, abstractmethod
-from datetime import datetime
+from functools import partial
 from time import sleep
-from typing import Dict, Optional, Tuple, Type, cast
+from typing import Callable, Dict, List, Optional, Tuple, Type, TypeVar, cast
 
 from faaskeeper.node import Node, NodeDataType
 from faaskeeper.operations import (
@@ -23,7 +23,84 @@ from functions.aws.control.distributor_events import (
 )
 from functions.aws.control.distributor_queue import DistributorQueue
 from functions.aws.model import SystemStorage
-from functions.aws.stats import TimingStatistics
+from functions.aws.stats import STATS_ENABLED, TimingStatistics
+
+T = TypeVar("T")
+
+# node updates applied by commits - shared and immutable
+_CHILDREN_ONLY = frozenset({NodeDataType.CHILDREN})
+_MODIFIED_ONLY = frozenset({NodeDataType.MODIFIED})
+_CREATE_ALL = frozenset(
+    {NodeDataType.CREATED, NodeDataType.MODIFIED, NodeDataType.CHILDREN}
+)
+
+
+def _acquire_lock(
+    lock: Callable[[int], Tuple[bool, T]],
+    description: str,
+    max_wait: float,
+    base: float = 0.05,
+    cap: float = 1.0,
+) -> Optional[Tuple[int, T]]:
+    """
+    Attempt locking with exponential backoff and jitter.
+    We stop once we waited for max_wait seconds - callers wait until a lock
+    abandoned by others can be taken over, or until the function runs out of time.
+    Returns the lock timestamp and the locked state, or None if all attempts failed.
+    """
+    waited = 0.0
+    attempt = 0
+    while True:
+        timestamp = int(time.time())
+        locked, state = lock(timestamp)
+        if locked:
+            return (timestamp, state)
+        if waited >= max_wait:
+            break
+        delay = min(cap, base * 2 ** attempt) * random.uniform(0.5, 1.5)
+        delay = min(delay, max_wait - waited)
+        sleep(delay)
+        waited += delay
+        attempt += 1
+    logging.error(f"Failed to lock {description} after waiting {waited:.2f}s")
+    return None
+
+
+def _split_path(path: str) -> Tuple[str, str]:
+    """
+    Returns the parent path and the node name.
+    ZooKeeper paths are always absolute - plain string split is sufficient.
+    """
+    parent_path, _, node_name = path.rpartition("/")
+    return (parent_path or "/", node_name)
+
+
+class _LockHolder:
+    """
+    Tracks the locks acquired by an operation.
+    When the operation fails, or an exception is raised while the holder
+    is entered, all held locks are released with a single request to the storage.
+    """
+
+    def __init__(self, system_storage: SystemStorage):
+        self._system_storage = system_storage
+        self._locks: List[Tuple[str, int]] = []
+
+    def __enter__(self) -> "_LockHolder":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.abort()
+        return False
+
+    def hold(self, path: str, timestamp: int):
+        self._locks.append((path, timestamp))
+
+    def abort(self):
+        if len(self._locks):
+            self._system_storage.unlock_nodes(self._locks)
+            self._locks = []
 
 
 class Executor(ABC):
@@ -31,7 +108,9 @@ class Executor(ABC):
         self._op = op
 
     @abstractmethod
-    def lock_and_read(self, system_storage: SystemStorage) -> Tuple[bool, dict]:
+    def lock_and_read(
+        self, system_storage: SystemStorage, max_wait: float
+    ) -> Tuple[bool, dict]:
         pass
 
     @abstractmethod
@@ -46,54 +125,50 @@ class Executor(ABC):
 class CreateNodeExecutor(Executor):
     def __init__(self, op: CreateNode):
         super().__init__(op)
+        self._parent_path, self._node_name = _split_path(op.path)
 
     @property
     def op(self) -> CreateNode:
         return cast(CreateNode, self._op)
 
-    def lock_and_read(self, system_storage: SystemStorage) -> Tuple[bool, dict]:
+    def lock_and_read(
+        self, system_storage: SystemStorage, max_wait: float
+    ) -> Tuple[bool, dict]:
 
         # TODO: ephemeral
         # TODO: sequential
         path = self.op.path
         logging.info(f"Attempting to create node at {path}")
 
-        # FIXME :limit number of attempts
-        while True:
-            self._timestamp = int(datetime.now().timestamp())
-            lock, node = system_storage.lock_node(path, self._timestamp)
-            if not lock:
-                sleep(2)
-            else:
-                break
+        # lock the node and the parent in a single operation
+        parent_path = self._parent_path
+        self._parent_timestamp: Optional[int] = None
+        self._locks = _LockHolder(system_storage)
+        locked = _acquire_lock(
+            partial(system_storage.lock_nodes, [path, parent_path]),
+            f"nodes {path}, {parent_path}",
+            max_wait,
+        )
+        if locked is None:
+            return (False, {"status": "failure", "path": path, "reason": "unknown"})
+        self._timestamp, (node, self._parent_node) = locked
+        self._parent_timestamp = self._timestamp
+        self._locks.hold(path, self._timestamp)
+        self._locks.hold(parent_path, self._parent_timestamp)
 
         # does the node exist?
         if node is not None:
-            system_storage.unlock_node(path, self._timestamp)
+            self._locks.abort()
             return (False, {"status": "failure", "path": path, "reason": "node_exists"})
 
-        # lock the parent - unless we're already at the root
-        node_path = pathlib.Path(path)
-        parent_path = node_path.parent.absolute()
-        self._parent_timestamp: Optional[int] = None
-        while True:
-            self._parent_timestamp = int(datetime.now().timestamp())
-            parent_lock, self._parent_node = system_storage.lock_node(
-                str(parent_path), self._parent_timestamp
-            )
-            if not parent_lock:
-                sleep(1)
-            else:
-                break
         # does the node does not exist?
         if self._parent_node is None:
-            system_storage.unlock_node(str(parent_path), self._parent_timestamp)
-            system_storage.unlock_node(path, self._timestamp)
+            self._locks.abort()
             return (
                 False,
                 {
                     "status": "failure",
-                    "path": str(parent_path),
+                    "path": parent_path,
                     "reason": "node_doesnt_exist",
                 },
             )
@@ -102,40 +177,41 @@ class CreateNodeExecutor(Executor):
 
     def commit_and_unlock(self, system_storage: SystemStorage) -> Tuple[bool, dict]:
 
-        assert self._parent_node
-        assert self._parent_timestamp
-
-        # FIXME: we shouldn't use writer ID anymore
-        self._counter = system_storage.increase_system_counter(0)
-        if self._counter is None:
-            return (False, {"status": "failure", "reason": "unknown"})
-
-        # store the created and the modified version counter
-        self._node = Node(self.op.path)
-        self._node.created = Version(self._counter, None)
-        self._node.modified = Version(self._counter, None)
-        self._node.children = []
-        # we propagate data to another queue, we should use the already
-        # base64-encoded data
-        # FIXME: keep the information if base64 encoding is actually applied?
-        # Important for Redis
-        self._node.data_b64 = self.op.data_b64
-
-        # FIXME: make both operations concurrently
-        # unlock parent
-        # parent now has one child more
-        self._parent_node.children.append(pathlib.Path(self.op.path).name)
-        system_storage.commit_node(
-            self._parent_node, self._parent_timestamp, set([NodeDataType.CHILDREN])
-        )
-        # commit node
-        system_storage.commit_node(
-            self._node,
-            self._timestamp,
-            set([NodeDataType.CREATED, NodeDataType.MODIFIED, NodeDataType.CHILDREN]),
-        )
-
-        return (True, {})
+        with self._locks:
+            assert self._parent_node
+            assert self._parent_timestamp
+
+            # FIXME: we shouldn't use writer ID anymore
+            self._counter = system_storage.increase_system_counter(0)
+            if self._counter is None:
+                self._locks.abort()
+                return (False, {"status": "failure", "reason": "unknown"})
+
+            # store the created and the modified version counter
+            self._node = Node(self.op.path)
+            self._node.created = Version(self._counter, None)
+            self._node.modified = Version(self._counter, None)
+            self._node.children = []
+            # we propagate data to another queue, we should use the already
+            # base64-encoded data
+            # FIXME: keep the information if base64 encoding is actually applied?
+            # Important for Redis
+            self._node.data_b64 = self.op.data_b64
+
+            # unlock parent
+            # parent now has one child more
+            self._parent_node.children.append(self._node_name)
+            # commit node - both changes are applied in a single transaction
+            if not system_storage.commit_nodes_transactional(
+                [
+                    (self._parent_node, self._parent_timestamp, _CHILDREN_ONLY),
+                    (self._node, self._timestamp, _CREATE_ALL),
+                ]
+            ):
+                self._locks.abort()
+                return (False, {"status": "failure", "reason": "unknown"})
+
+            return (True, {})
 
     def distributor_push(self, client: Client, distributor_queue: DistributorQueue):
 
@@ -156,7 +232,9 @@ class DeregisterSessionExecutor(Executor):
     def op(self) -> DeregisterSession:
         return cast(DeregisterSession, self._op)
 
-    def lock_and_read(self, system_storage: SystemStorage) -> Tuple[bool, dict]:
+    def lock_and_read(
+        self, system_storage: SystemStorage, max_wait: float
+    ) -> Tuple[bool, dict]:
         return (True, {})
 
     def distributor_push(self, client: Client, distributor_queue: DistributorQueue):
@@ -185,33 +263,38 @@ class SetDataExecutor(Executor):
     def __init__(self, op: SetData):
         super().__init__(op)
         self._stats = TimingStatistics.instance()
+        self._timings: Dict[str, float] = {}
         self._begin = 0.0
 
     @property
     def op(self) -> SetData:
         return cast(SetData, self._op)
 
-    def lock_and_read(self, system_storage: SystemStorage) -> Tuple[bool, dict]:
+    def lock_and_read(
+        self, system_storage: SystemStorage, max_wait: float
+    ) -> Tuple[bool, dict]:
 
         path = self.op.path
         logging.info(f"Attempting to write data at {path}")
-        self._begin = time.time()
-
-        begin_lock = time.time()
-        # FIXME :limit number of attempts
-        while True:
-            self._timestamp = int(datetime.now().timestamp())
-            lock, self._system_node = system_storage.lock_node(path, self._timestamp)
-            if not lock:
-                sleep(2)
-            else:
-                break
-        end_lock = time.time()
-        self._stats.add_result("lock", end_lock - begin_lock)
+        if STATS_ENABLED:
+            self._begin = time.perf_counter()
+
+        self._locks = _LockHolder(system_storage)
+        locked = _acquire_lock(
+            partial(system_storage.lock_node, path),
+            f"node {path}",
+            max_wait,
+        )
+        if locked is None:
+            return (False, {"status": "failure", "path": path, "reason": "unknown"})
+        self._timestamp, self._system_node = locked
+        self._locks.hold(path, self._timestamp)
+        if STATS_ENABLED:
+            self._timings["lock"] = time.perf_counter() - self._begin
 
         # does the node exist?
         if self._system_node is None:
-            system_storage.unlock_node(path, self._timestamp)
+            self._locks.abort()
             return (
                 False,
                 {"status": "failure", "path": path, "reason": "node_doesnt_exist"},
@@ -224,7 +307,8 @@ class SetDataExecutor(Executor):
         assert self._counter
         assert self._system_node
 
-        begin_push = time.time()
+        if STATS_ENABLED:
+            begin_push = time.perf_counter()
 
         assert distributor_queue
         distributor_queue.push(
@@ -232,87 +316,90 @@ class SetDataExecutor(Executor):
             DistributorSetData(client.session_id, self._system_node),
             client,
         )
-        end_push = time.time()
-        self._stats.add_result("push", end_push - begin_push)
+        if STATS_ENABLED:
+            self._timings["push"] = time.perf_counter() - begin_push
 
-    def commit_and_unlock(self, system_storage: SystemStorage) -> Tuple[bool, dict]:
+            # push is the last stage - submit measurements of the entire operation
+            self._stats.add_batch(self._timings)
+            self._stats.add_repetition()
 
-        assert self._system_node
-
-        begin_atomic = time.time()
-        # FIXME: we shouldn't use writer ID anymore
-        self._counter = system_storage.increase_system_counter(0)
-        if self._counter is None:
-            return (False, {"status": "failure", "reason": "unknown"})
-        end_atomic = time.time()
-        self._stats.add_result("atomic", end_atomic - begin_atomic)
-
-        begin_commit = time.time()
-        # store only the modified version counter
-        # the new data will be written by the distributor
-        self._system_node.modified = Version(self._counter, None)
-        self._system_node.data_b64 = self.op.data_b64
-        if not system_storage.commit_node(
-            self._system_node, self._timestamp, set([NodeDataType.MODIFIED])
-        ):
-            return (False, {"status": "failure", "reason": "unknown"})
-        end_commit = time.time()
-        self._stats.add_result("commit", end_commit - begin_commit)
-
-        end = time.time()
-        self._stats.add_result("total", end - self._begin)
-        self._stats.add_repetition()
+    def commit_and_unlock(self, system_storage: SystemStorage) -> Tuple[bool, dict]:
 
-        return (True, {})
+        with self._locks:
+            assert self._system_node
+
+            if STATS_ENABLED:
+                begin_atomic = time.perf_counter()
+            # FIXME: we shouldn't use writer ID anymore
+            self._counter = system_storage.increase_system_counter(0)
+            if self._counter is None:
+                self._locks.abort()
+                return (False, {"status": "failure", "reason": "unknown"})
+            if STATS_ENABLED:
+                begin_commit = time.perf_counter()
+                self._timings["atomic"] = begin_commit - begin_atomic
+
+            # store only the modified version counter
+            # the new data will be written by the distributor
+            self._system_node.modified = Version(self._counter, None)
+            self._system_node.data_b64 = self.op.data_b64
+            if not system_storage.commit_node(
+                self._system_node, self._timestamp, _MODIFIED_ONLY
+            ):
+                self._locks.abort()
+                return (False, {"status": "failure", "reason": "unknown"})
+            if STATS_ENABLED:
+                end = time.perf_counter()
+                self._timings["commit"] = end - begin_commit
+                self._timings["total"] = end - self._begin
+
+            return (True, {})
 
 
 class DeleteNodeExecutor(Executor):
     def __init__(self, op: DeleteNode):
         super().__init__(op)
+        self._parent_path, self._node_name = _split_path(op.path)
 
     @property
     def op(self) -> DeleteNode:
         return cast(DeleteNode, self._op)
 
-    def lock_and_read(self, system_storage: SystemStorage) -> Tuple[bool, dict]:
+    def lock_and_read(
+        self, system_storage: SystemStorage, max_wait: float
+    ) -> Tuple[bool, dict]:
 
         path = self.op.path
         logging.info(f"Attempting to delete node at {path}")
 
-        # FIXME :limit number of attempts
-        while True:
-            self._timestamp = int(datetime.now().timestamp())
-            lock, self._node = system_storage.lock_node(path, self._timestamp)
-            if not lock:
-                sleep(2)
-            else:
-                break
+        # lock the node and the parent in a single operation
+        parent_path = self._parent_path
+        self._parent_timestamp: Optional[int] = None
+        self._locks = _LockHolder(system_storage)
+        locked = _acquire_lock(
+            partial(system_storage.lock_nodes, [path, parent_path]),
+            f"nodes {path}, {parent_path}",
+            max_wait,
+        )
+        if locked is None:
+            return (False, {"status": "failure", "path": path, "reason": "unknown"})
+        self._timestamp, (self._node, self._parent_node) = locked
+        self._parent_timestamp = self._timestamp
+        self._locks.hold(path, self._timestamp)
+        self._locks.hold(parent_path, self._parent_timestamp)
 
         # does the node not exist?
         if self._node is None:
-            system_storage.unlock_node(path, self._timestamp)
+            self._locks.abort()
             return (
                 False,
                 {"status": "failure", "path": path, "reason": "node_doesnt_exist"},
             )
 
         if len(self._node.children):
-            system_storage.unlock_node(path, self._timestamp)
+            self._locks.abort()
             return (False, {"status": "failure", "path": path, "reason": "not_empty"})
 
-        # lock the parent - unless we're already at the root
-        node_path = pathlib.Path(path)
-        parent_path = node_path.parent.absolute()
-        self._parent_timestamp: Optional[int] = None
-        while True:
-            self._parent_timestamp = int(datetime.now().timestamp())
-            parent_lock, self._parent_node = system_storage.lock_node(
-                str(parent_path), self._parent_timestamp
-            )
-            if not parent_lock:
-                sleep(2)
-            else:
-                break
         assert self._parent_node
 
         return (True, {})
@@ -332,41 +419,52 @@ class DeleteNodeExecutor(Executor):
 
     def commit_and_unlock(self, system_storage: SystemStorage) -> Tuple[bool, dict]:
 
-        assert self._node
-        assert self._timestamp
-        assert self._parent_node
-        assert self._parent_timestamp
-
-        # FIXME: we shouldn't use writer ID anymore
-        self._counter = system_storage.increase_system_counter(0)
-        if self._counter is None:
-            return (False, {"status": "failure", "reason": "unknown"})
-
-        # remove child from parent node
-        self._parent_node.children.remove(pathlib.Path(self.op.path).name)
-
-        # commit system storage
-        # FIXME: as a transaction
-        system_storage.commit_node(
-            self._parent_node, self._parent_timestamp, set([NodeDataType.CHILDREN])
-        )
-        system_storage.delete_node(self._node, self._timestamp)
-
-        return (True, {})
+        with self._locks:
+            assert self._node
+            assert self._timestamp
+            assert self._parent_node
+            assert self._parent_timestamp
+
+            # FIXME: we shouldn't use writer ID anymore
+            self._counter = system_storage.increase_system_counter(0)
+            if self._counter is None:
+                self._locks.abort()
+                return (False, {"status": "failure", "reason": "unknown"})
+
+            # remove child from parent node
+            self._parent_node.children.remove(self._node_name)
+
+            # commit system storage
+            if not system_storage.commit_nodes_transactional(
+                [(self._parent_node, self._parent_timestamp, _CHILDREN_ONLY)],
+                [(self._node, self._timestamp)],
+            ):
+                self._locks.abort()
+                return (False, {"status": "failure", "reason": "unknown"})
+
+            return (True, {})
+
+
+_OPS: Dict[str, Tuple[Type[RequestOperation], Type[Executor]]] = {
+    "create_node": (CreateNode, CreateNodeExecutor),
+    "set_data": (SetData, SetDataExecutor),
+    "delete_node": (DeleteNode, DeleteNodeExecutor),
+    "deregister_session": (DeregisterSession, DeregisterSessionExecutor),
+}
+_DESERIALIZERS: Dict[str, Callable[[dict], Optional[RequestOperation]]] = {
+    name: op_type.deserialize for name, (op_type, _) in _OPS.items()
+}
+_EXECUTORS: Dict[str, Type[Executor]] = {
+    name: executor_type for name, (_, executor_type) in _OPS.items()
+}
 
 
 def builder(
     operation: str, event_id: str, event: dict
 ) -> Tuple[Optional[Executor], dict]:
 
-    ops: Dict[str, Tuple[Type[RequestOperation], Type[Executor]]] = {
-        "create_node": (CreateNode, CreateNodeExecutor),
-        "set_data": (SetData, SetDataExecutor),
-        "delete_node": (DeleteNode, DeleteNodeExecutor),
-        "deregister_session": (DeregisterSession, DeregisterSessionExecutor),
-    }
-
-    if operation not in ops:
+    deserializer = _DESERIALIZERS.get(operation)
+    if deserializer is None:
         logging.error(
             "Unknown operation {op} with ID {event_id}, "
             "timestamp {timestamp}".format(
@@ -378,8 +476,7 @@ def builder(
         error_msg = {"status": "failure", "reason": "incorrect_request"}
         return (None, error_msg)
 
-    operation_type, executor_type = ops[operation]
-    op = operation_type.deserialize(event)
+    op = deserializer(event)
     if op is None:
         logging.error(
             "Incorrect event with ID {id}, timestamp {timestamp}".format(
@@ -389,4 +486,4 @@ def builder(
         error_msg = {"status": "failure", "reason": "incorrect_request"}
         return (None, error_msg)
 
-    return (executor_type(op), {})
+    return (_EXECUTORS[operation](op), {})
@@ -1,5 +1,9 @@
+import os
 from collections import defaultdict
-from typing import Optional
+from typing import Dict, Optional
+
+# timing measurements are disabled unless explicitly requested
+STATS_ENABLED = os.environ.get("FK_STATS") == "1"
 
 
 class TimingStatistics:
@@ -29,6 +33,10 @@ class TimingStatistics:
     def add_result(self, key: str, val: float):
         self._results[key] += val
 
+    def add_batch(self, results: Dict[str, float]):
+        for key, val in results.items():
+            self._results[key] += val
+
     def print(self):
 
         for key, value in self._results.items():
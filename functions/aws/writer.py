@@ -7,17 +7,22 @@ from functions.aws.config import Config
 from functions.aws.control.channel import Client
 from functions.aws.operations import Executor
 from functions.aws.operations import builder as operations_builder
-from functions.aws.stats import TimingStatistics
+from functions.aws.stats import STATS_ENABLED, TimingStatistics
 
 config = Config.instance()
 timing_stats = TimingStatistics.instance()
 
+# time reserved for the commit and the distributor push of the last operation
+_COMMIT_RESERVE = 5.0
 
-def execute_operation(op_exec: Executor, client: Client) -> Optional[dict]:
+
+def execute_operation(
+    op_exec: Executor, client: Client, max_wait: float
+) -> Optional[dict]:
 
     try:
 
-        status, ret = op_exec.lock_and_read(config.system_storage)
+        status, ret = op_exec.lock_and_read(config.system_storage, max_wait)
         if not status:
             return ret
 
@@ -50,6 +55,9 @@ def handler(event: dict, context):
     logging.info(f"Begin processing {len(events)} events")
     processed_events = 0
     StorageStatistics.instance().reset()
+    # Events are processed strictly one after another. Operations of a session
+    # must be applied and pushed to the distributor in the order of arrival,
+    # and the order of system counters must match the order of pushes.
     for record in events:
 
         # FIXME: abstract away, hide the DynamoDB conversion
@@ -79,7 +87,14 @@ def handler(event: dict, context):
             config.client_channel.notify(client, error)
             continue
 
-        ret = execute_operation(executor, client)
+        # All events of a batch share the function timeout, and a timeout would
+        # redeliver the entire batch - including operations already committed.
+        # Thus, we never wait for locks beyond the time left in the invocation.
+        max_wait = min(
+            config.system_storage.lock_wait,
+            context.get_remaining_time_in_millis() / 1000 - _COMMIT_RESERVE,
+        )
+        ret = execute_operation(executor, client, max(max_wait, 0.0))
 
         if ret:
             if ret["status"] == "failure":
@@ -91,7 +106,7 @@ def handler(event: dict, context):
         else:
             processed_events += 1
 
-        if timing_stats.repetitions % 100 == 0:
+        if STATS_ENABLED and timing_stats.repetitions % 100 == 0:
             timing_stats.print()
 
     print(f"Successfully processed {processed_events} records out of {len(events)}")